@@ -1,12 +1,21 @@
 import os
 import re
+import math
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
 from thefuzz import process as thefuzz_process
+from thefuzz import utils as thefuzz_utils
 from joblib import Parallel, delayed
+from tqdm import tqdm as console_tqdm
 from tqdm.notebook import tqdm
 
+# For the progress_apply calls in finalise_groupby, which out_of_core uses
+# without going through procurement_matching.
+console_tqdm.pandas()
+
 
 def fuzzy_match(supplier, choices):
     return thefuzz_process.extract(supplier, choices=choices, limit=5)
@@ -24,26 +33,59 @@ def filter_coercible_to_string(series):
     """Filter out any values in the pandas Series that cannot be coerced to a string."""
     return series[series.apply(is_string_coercible)].astype(str)
 
-def make_matches(input_1, input_2, match_type):
-    suppliers = input_1.tolist()
-    choices = input_2.tolist()
-    results = Parallel(n_jobs=28)(
-        delayed(fuzzy_match)(supplier, choices) for supplier in tqdm(suppliers)
-    )
-    columns = [
-        "best_" + match_type + "_match_1", "best_" + match_type + "_match_1_score",
-        "best_" + match_type + "_match_2", "best_" + match_type + "_match_2_score",
-        "best_" + match_type + "_match_3", "best_" + match_type + "_match_3_score",
-        "best_" + match_type + "_match_4", "best_" + match_type + "_match_4_score",
-        "best_" + match_type + "_match_5", "best_" + match_type + "_match_5_score"
-    ]
+def fuzzy_match_chunk(queries, choices):
+    return [fuzzy_match(query, choices) for query in queries]
+
+
+def match_columns(match_type, limit=5):
+    columns = []
+    for rank in range(1, limit + 1):
+        columns.extend(["best_" + match_type + "_match_" + str(rank),
+                        "best_" + match_type + "_match_" + str(rank) + "_score"])
+    return columns
+
+
+def match_rows(results):
     rows = []
     for match_list in results:
         row = []
         for match, score in match_list:
             row.extend([match, score])
         rows.append(row)
-    return pd.DataFrame(rows, columns=columns)
+    return rows
+
+
+def make_matches(input_1, input_2, match_type):
+    return make_multi_matches(input_1, {match_type: input_2})
+
+
+def make_multi_matches(input_1, registers, n_jobs=28, max_chunk_size=1000):
+    """Match the suppliers against several registers in a single pass.
+
+    The queries are preprocessed and de-duplicated once, and the work for
+    every register is scheduled in the same worker pool. `registers` maps a
+    match type (e.g. 'spine', 'ch') to its series of normalised names, and
+    the returned frame holds the best_<type>_match_N columns for each.
+    """
+    suppliers = input_1.tolist()
+    queries = [thefuzz_utils.full_process(supplier, force_ascii=True) for supplier in suppliers]
+    unique_queries = list(dict.fromkeys(queries))
+    # Small enough chunks that every worker gets some of each register's work.
+    chunk_size = min(max_chunk_size, max(1, math.ceil(len(unique_queries) / n_jobs)))
+    chunks = [unique_queries[i:i + chunk_size] for i in range(0, len(unique_queries), chunk_size)]
+    choices = {match_type: register.tolist() for match_type, register in registers.items()}
+    tasks = [(match_type, chunk) for match_type in choices for chunk in chunks]
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(fuzzy_match_chunk)(chunk, choices[match_type]) for match_type, chunk in tqdm(tasks)
+    )
+    matches = {match_type: {} for match_type in choices}
+    for (match_type, chunk), chunk_results in zip(tasks, results):
+        matches[match_type].update(zip(chunk, chunk_results))
+    frames = []
+    for match_type in choices:
+        rows = match_rows(matches[match_type][query] for query in queries)
+        frames.append(pd.DataFrame(rows, columns=match_columns(match_type)))
+    return pd.concat(frames, axis=1)
 
 
 def process_dates(date_string):
@@ -115,6 +157,48 @@ def prepare_nhsspend(df_nhs):
                    'NHSSpend_isCIC']]
 
 
+def finalise_groupby(df_uniq, df_counts, df_nhs_ids):
+    """Turn the per-supplier aggregates into the merged_groupby_raw layout."""
+    df_uniq[['SUPPLIER', 'ORG_COUNT']] = df_uniq['SUPPLIER'].progress_apply(lambda x: pd.Series(org_counter(x)))
+    df_uniq['NORMALIZED_SUPPLIER'] = df_uniq['SUPPLIER'].progress_apply(normaliser)
+    df_uniq = pd.merge(df_uniq,
+                       df_counts,
+                       how='left',
+                       left_on='SUPPLIER',
+                       right_on='SUPPLIER'
+                       )
+    df_uniq.sort_values(by=['amount'],
+                        ascending=False)
+
+    df_uniq = pd.merge(df_uniq,
+                       df_nhs_ids,
+                       how='left',
+                       left_on='SUPPLIER',
+                       right_on='supplier'
+                       )
+
+    df_uniq = df_uniq.rename({'count': 'PAYMENT_TOTAL_COUNT',
+                              'amount': 'PAYMENT_TOTAL_AMOUNT'},
+                             axis=1)
+    print(f'Dropping {len(df_uniq[df_uniq["ORG_COUNT"] != 1])} org_count !=1')
+    df_uniq = df_uniq[df_uniq['ORG_COUNT'] == 1]
+    df_uniq = df_uniq.drop(columns='supplier')
+    df_uniq['contractsfinder_awardedToVcse'] = df_uniq['contractsfinder_awardedToVcse'].apply(
+        lambda x: "True" if True in x else "False")
+    df_uniq['deptcount'] = df_uniq['dept'].astype(str).apply(lambda x: x.count(';') + 1)
+    df_uniq['date'] = df_uniq['date'].astype(str).progress_apply(process_dates)
+    df_uniq['SUPPLIER'] = df_uniq['SUPPLIER'].replace('"', "[DQ]", regex=True)
+
+    df_uniq = df_uniq.drop('NHSSpend_CharityNameNo', axis=1)
+    df_uniq = df_uniq.drop('NHSSpend_CharityName', axis=1)
+    df_uniq = df_uniq.drop('NHSSpend_CompanyName', axis=1)
+
+    df_uniq = df_uniq.sort_values(by='PAYMENT_TOTAL_AMOUNT',
+                                  ascending=False)
+    df_uniq['NORMALIZED_SUPPLIER'] = filter_coercible_to_string(df_uniq['NORMALIZED_SUPPLIER'])
+    return df_uniq
+
+
 def parse_datetime(value):
     try:
         return pd.to_datetime(value, format='%Y/%m/%d', errors='coerce')
@@ -122,17 +206,50 @@ def parse_datetime(value):
         return pd.NaT
 
 
+RAW_DATA_USECOLS = {
+    'centgov_data.csv': ['amount', 'supplier', 'date', 'dept'],
+    'nhsspend_data.csv': ['amount', 'supplier', 'date', 'dept',
+                          'CompanyName', 'CompanyNumber', 'CharityRegNo',
+                          'CharitySubNo', 'CharityNameNo', 'CharityName',
+                          'audit_type', 'CHnotes', 'CCnotes', 'isCIC'],
+    'contractsfinder_data.csv': ['awardedDate', 'awardedSupplier', 'awardedValue',
+                                 'organisationName', 'awardedToVcse', 'region'],
+}
+
+
+def read_csv_fast(path, usecols=None):
+    df = pd.read_csv(path, usecols=usecols, engine='pyarrow')
+    # The pyarrow engine gives None for missing strings where the C engine gave
+    # NaN, which would show up in the unique_agg lists and normalised names.
+    object_columns = df.select_dtypes(include='object').columns
+    df[object_columns] = df[object_columns].where(df[object_columns].notnull(), np.nan)
+    return df
+
+
 def read_raw_data(fname, data_type):
-    df = pd.read_csv(os.path.join(os.getcwd(),
-                                  '..',
-                                  'raw_data',
-                                  fname),
-                     low_memory=False,
-                    )
+    df = read_csv_fast(os.path.join(os.getcwd(),
+                                    '..',
+                                    'raw_data',
+                                    fname),
+                       usecols=RAW_DATA_USECOLS.get(fname),
+                       )
     df['data_source'] = data_type
     return df
 
 
+def read_all_raw_data():
+    """Load the centgov, NHSSpend and Contracts Finder csvs concurrently."""
+    with ThreadPoolExecutor() as executor:
+        df_centgov = executor.submit(read_raw_data, 'centgov_data.csv', 'Contracts Finder')
+        df_nhs = executor.submit(read_raw_data, 'nhsspend_data.csv', 'NHSSpend')
+        df_contracts = executor.submit(read_raw_data, 'contractsfinder_data.csv', 'Contracts Finder')
+        return df_centgov.result(), df_nhs.result(), df_contracts.result()
+
+
+def read_register(fname, usecols):
+    return read_csv_fast(os.path.join('..', 'registers', fname), usecols=usecols)
+
+
 def process_cleanname(cleanname):
     cleanname = " " + cleanname + " "
     cleanname = cleanname.replace(" PTFA ", " PTA ")
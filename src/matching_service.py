@@ -0,0 +1,153 @@
+import os
+import json
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+
+from matching_helpers import normaliser
+from register_index import REGISTERS,\
+                           RegisterIndex,\
+                           index_path
+
+
+# Each worker process maps the register indexes once; the pages are shared
+# between the workers rather than copied into each of them.
+worker_indexes = {}
+
+MAX_LIMIT = 50
+
+
+def init_worker(registers):
+    for register in registers:
+        worker_indexes[register] = RegisterIndex(index_path(register))
+
+
+def normalise_chunk(suppliers):
+    return [normaliser(supplier) for supplier in suppliers]
+
+
+def match_chunk(suppliers, registers, limit):
+    frames = [worker_indexes[register].match_batch(suppliers, register, limit=limit)
+              for register in registers]
+    df_results = pd.concat(frames, axis=1)
+    return df_results.astype(object).where(df_results.notnull(), None).to_dict('records')
+
+
+def chunked(values, chunk_size):
+    return [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+
+
+class MatchingHandler(BaseHTTPRequestHandler):
+    """POST /normalise and POST /match, both taking {"suppliers": [...]}.
+
+    /match also takes "registers" (default: all loaded) and "limit", and
+    returns one best_<type>_match_N record per supplier.
+    """
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            suppliers = request['suppliers']
+            registers = request.get('registers', self.server.registers)
+            limit = int(request.get('limit', 5))
+            if not isinstance(suppliers, list) or not all(isinstance(s, str) for s in suppliers):
+                raise ValueError('"suppliers" must be a list of strings')
+            if not isinstance(registers, list) or not registers or not set(registers) <= set(self.server.registers):
+                raise ValueError(f'"registers" must be a non-empty list drawn from {self.server.registers}')
+            if not 1 <= limit <= MAX_LIMIT:
+                raise ValueError(f'"limit" must be between 1 and {MAX_LIMIT}')
+        except (ValueError, KeyError, TypeError) as e:
+            return self.send_json(400, {'error': str(e)})
+        if len(suppliers) > self.server.max_batch:
+            return self.send_json(413, {'error': f'at most {self.server.max_batch} suppliers per request'})
+
+        if self.path not in ('/normalise', '/match'):
+            return self.send_json(404, {'error': f'no such endpoint: {self.path}'})
+        try:
+            if self.path == '/normalise':
+                body = {'normalised': self.run(normalise_chunk, suppliers)}
+            else:
+                body = {'matches': self.run(match_chunk, suppliers, registers, limit)}
+        except Exception as e:
+            # Includes errors raised in the workers and a broken pool; the
+            # client still gets a response rather than a dropped connection.
+            self.log_error('matching failed: %r', e)
+            return self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+        return self.send_json(200, body)
+
+    def run(self, func, suppliers, *args):
+        """Spread a batch over the worker pool, limiting how many batches run at once."""
+        with self.server.slots:
+            pool = self.server.pool
+            try:
+                futures = [pool.submit(func, chunk, *args)
+                           for chunk in chunked(suppliers, self.server.chunk_size)]
+                return [result for future in futures for result in future.result()]
+            except BrokenProcessPool:
+                replace_pool(self.server, pool)
+                raise
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_pool(registers, workers):
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                               initializer=init_worker,
+                               initargs=(registers,))
+
+
+def replace_pool(server, broken_pool):
+    """Start a new worker pool after a worker has died.
+
+    A pool is unusable once one of its processes has gone, so without this
+    every later request would fail too. Only the first request to see the
+    broken pool replaces it.
+    """
+    with server.pool_lock:
+        if server.pool is broken_pool:
+            broken_pool.shutdown(wait=False)
+            server.pool = start_pool(server.registers, server.workers)
+
+
+def serve(host='127.0.0.1', port=8765, registers=None, workers=None,
+          max_concurrent=4, max_batch=5000, chunk_size=50):
+    registers = list(registers or REGISTERS)
+    for register in registers:
+        # Fail at startup rather than in the workers if an index is missing.
+        RegisterIndex(index_path(register))
+    server = ThreadingHTTPServer((host, port), MatchingHandler)
+    server.registers = registers
+    server.workers = workers
+    server.pool = start_pool(registers, workers)
+    server.pool_lock = threading.Lock()
+    server.slots = threading.BoundedSemaphore(max_concurrent)
+    server.max_batch = max_batch
+    server.chunk_size = chunk_size
+    print(f'Serving {", ".join(registers)} matches on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    finally:
+        server.pool.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--registers', nargs='+', help='any of ' + ', '.join(REGISTERS) + ' (default: all)')
+    parser.add_argument('--workers', type=int, help='matching processes (default: one per cpu)')
+    parser.add_argument('--max-concurrent', type=int, default=4,
+                        help='requests matched at once; the rest wait')
+    parser.add_argument('--max-batch', type=int, default=5000, help='suppliers allowed per request')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.registers, args.workers, args.max_concurrent, args.max_batch)
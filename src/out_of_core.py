@@ -0,0 +1,330 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import duckdb
+
+from matching_helpers import normaliser,\
+                             org_counter,\
+                             strip_html,\
+                             finalise_groupby,\
+                             RAW_DATA_USECOLS
+from output_writer import clear_payments_dataset,\
+                          raw_data_path,\
+                          write_groupby
+
+
+# Rows are ordered by (source, row within source) so that the outputs come out
+# in the same order as the pd.concat([df_nhs, df_centgov, df_contracts]) path.
+SOURCE_STRIDE = 1 << 40
+
+REDACTED_SUPPLIERS = ["SUCCESSFUL SUPPL",
+                      "SEE ATTACH",
+                      "REFER ATTACH",
+                      "CONTRACT WAS AWARD",
+                      "AWARDED SUPPLIERS",
+                      "SUCCESSFUL SUPPLIER",
+                      "PLEASE SEE",
+                      'NAMED IND',
+                      'REDACT',
+                      "PLEASE REFER"]
+
+PAYMENT_COLUMNS = ['data_source', 'amount', 'SUPPLIER', 'date', 'dept',
+                   'NHSSpend_CompanyNumber',
+                   'NHSSpend_CharityRegNo',
+                   'NHSSpend_CharitySubNo',
+                   'NHSSpend_isCIC',
+                   'contractsfinder_awardedToVcse',
+                   'contractsfinder_region',
+                   'NORMALIZED_SUPPLIER',
+                   'ORG_COUNT']
+
+# The strings pd.read_csv treats as NaN by default.
+PANDAS_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+                    '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None',
+                    'n/a', 'nan', 'null']
+
+# The columns the cleaning relies on. The other RAW_DATA_USECOLS are read as
+# text and typed by infer_column_types.
+PINNED_TYPES = {'amount': 'DOUBLE',
+                'supplier': 'VARCHAR',
+                'date': 'VARCHAR',
+                'awardedValue': 'DOUBLE',
+                'awardedSupplier': 'VARCHAR',
+                'awardedDate': 'VARCHAR'}
+
+# The strings the pyarrow csv reader parses as booleans.
+TRUE_STRINGS = ['1', 'True', 'TRUE', 'true']
+FALSE_STRINGS = ['0', 'False', 'FALSE', 'false']
+
+UNIQUE_COLUMNS = ['contractsfinder_awardedToVcse',
+                  'contractsfinder_region',
+                  'date',
+                  'dept']
+
+
+def upper_strip(supplier):
+    return supplier.upper().strip()
+
+
+def format_payment_date(date):
+    if date is None:
+        return None
+    date = pd.to_datetime(date.split('T')[0], format='mixed', errors='coerce')
+    return date.strftime('%d-%m-%Y') if pd.notnull(date) else None
+
+
+def register_udfs(con):
+    con.create_function('upper_strip', upper_strip, ['VARCHAR'], 'VARCHAR')
+    con.create_function('strip_html', strip_html, ['VARCHAR'], 'VARCHAR')
+    # Unparseable dates come back as NULL, and are dropped by "date IS NOT NULL".
+    con.create_function('format_payment_date', format_payment_date, ['VARCHAR'], 'VARCHAR',
+                        null_handling='special')
+    con.create_function('normaliser', normaliser, ['VARCHAR'], 'VARCHAR')
+    con.create_function('org_counter_name', lambda x: org_counter(x)[0], ['VARCHAR'], 'VARCHAR')
+    con.create_function('org_counter_count', lambda x: org_counter(x)[1], ['VARCHAR'], 'BIGINT')
+
+
+def sql_strings(values):
+    return ', '.join(f"'{value}'" for value in values)
+
+
+def csv_source(fname):
+    """read_csv over a raw data file, with pandas' default NA strings read as NULL."""
+    path = raw_data_path(fname).replace("'", "''")
+    types = ', '.join(f"'{col}': '{PINNED_TYPES.get(col, 'VARCHAR')}'" for col in RAW_DATA_USECOLS[fname])
+    return f"read_csv('{path}', header=true, nullstr=[{sql_strings(PANDAS_NA_VALUES)}], types={{{types}}})"
+
+
+def infer_column_types(con, fname):
+    """The type pd.read_csv(engine='pyarrow') would give each unpinned column.
+
+    DuckDB only sniffs the first rows of a csv, so a column of numbers that
+    later holds text (e.g. a Scottish "SC123456" company number) would fail
+    to convert part way through. Instead the values are checked over the
+    whole file: integers are BIGINT, or DOUBLE where there are NULLs as
+    pandas would make them float64, then DOUBLE, BOOLEAN and VARCHAR.
+    """
+    columns = [col for col in RAW_DATA_USECOLS[fname] if col not in PINNED_TYPES]
+    checks = []
+    for col in columns:
+        # Each bool_and is NULL for a column that is all NULL, leaving it VARCHAR.
+        checks += [f"count({col}) = count(*)",
+                   f"bool_and(regexp_full_match({col}, '[+-]?[0-9]+') AND TRY_CAST({col} AS BIGINT) IS NOT NULL) "
+                   f"FILTER (WHERE {col} IS NOT NULL)",
+                   f"bool_and(TRY_CAST({col} AS DOUBLE) IS NOT NULL) FILTER (WHERE {col} IS NOT NULL)",
+                   f"bool_and({col} IN ({sql_strings(TRUE_STRINGS + FALSE_STRINGS)}))"]
+    row = con.execute(f"SELECT {', '.join(checks)} FROM {csv_source(fname)}").fetchone()
+    types = {}
+    for i, col in enumerate(columns):
+        no_nulls, is_integer, is_double, is_boolean = row[4 * i:4 * i + 4]
+        if is_integer:
+            types[col] = 'BIGINT' if no_nulls else 'DOUBLE'
+        elif is_double:
+            types[col] = 'DOUBLE'
+        elif is_boolean:
+            types[col] = 'BOOLEAN'
+        else:
+            types[col] = 'VARCHAR'
+    return types
+
+
+def typed_source(con, fname):
+    casts = ', '.join(f'CAST({col} AS {col_type}) AS {col}'
+                      for col, col_type in infer_column_types(con, fname).items())
+    return f"(SELECT * REPLACE ({casts}) FROM {csv_source(fname)})"
+
+
+def create_source_views(con):
+    """Lazy equivalents of read_raw_data followed by the prepare_* functions."""
+    con.execute(f"""
+        CREATE VIEW nhs AS
+        SELECT 0 * {SOURCE_STRIDE} + row_number() OVER () AS _order,
+               'NHSSpend' AS data_source, amount, supplier, date, dept,
+               CompanyName AS NHSSpend_CompanyName,
+               CompanyNumber AS NHSSpend_CompanyNumber,
+               CharityRegNo AS NHSSpend_CharityRegNo,
+               CharitySubNo AS NHSSpend_CharitySubNo,
+               CharityNameNo AS NHSSpend_CharityNameNo,
+               CharityName AS NHSSpend_CharityName,
+               audit_type AS NHSSpend_audit_type,
+               CHnotes AS NHSSpend_CHnotes,
+               CCnotes AS NHSSpend_CCnotes,
+               isCIC AS NHSSpend_isCIC
+        FROM {typed_source(con, 'nhsspend_data.csv')}
+    """)
+    con.execute(f"""
+        CREATE VIEW centgov AS
+        SELECT 1 * {SOURCE_STRIDE} + row_number() OVER () AS _order,
+               'Contracts Finder' AS data_source, amount, supplier, date, dept
+        FROM {typed_source(con, 'centgov_data.csv')}
+    """)
+    con.execute(f"""
+        CREATE VIEW contracts AS
+        SELECT 2 * {SOURCE_STRIDE} + row_number() OVER () AS _order,
+               'Contracts Finder' AS data_source,
+               awardedValue AS amount,
+               awardedSupplier AS supplier,
+               awardedDate AS date,
+               organisationName AS dept,
+               awardedToVcse AS contractsfinder_awardedToVcse,
+               region AS contractsfinder_region
+        FROM {typed_source(con, 'contractsfinder_data.csv')}
+    """)
+
+
+def create_payments_table(con):
+    """Apply the payment-level cleaning and filters, materialising on disk."""
+    redacted = ' AND '.join(f"NOT contains(SUPPLIER, '{supplier}')" for supplier in REDACTED_SUPPLIERS)
+    con.execute(f"""
+        CREATE TABLE payments AS
+        WITH combined AS (
+            SELECT * EXCLUDE (supplier), upper_strip(supplier) AS SUPPLIER
+            FROM (SELECT * FROM nhs
+                  UNION ALL BY NAME SELECT * FROM centgov
+                  UNION ALL BY NAME SELECT * FROM contracts)
+        ), cleaned AS (
+            SELECT * EXCLUDE (SUPPLIER, date),
+                   strip_html(SUPPLIER) AS SUPPLIER,
+                   format_payment_date(date) AS date
+            FROM combined
+            WHERE SUPPLIER IS NOT NULL
+              AND TRY_CAST(SUPPLIER AS DOUBLE) IS NULL
+              AND amount IS NOT NULL
+              AND dept IS NOT NULL
+        ), normalised AS (
+            SELECT *, normaliser(SUPPLIER) AS NORMALIZED_SUPPLIER
+            FROM cleaned
+            WHERE SUPPLIER IS NOT NULL AND date IS NOT NULL
+        ), counted AS (
+            SELECT * EXCLUDE (SUPPLIER),
+                   org_counter_name(SUPPLIER) AS SUPPLIER,
+                   org_counter_count(SUPPLIER) AS ORG_COUNT
+            FROM normalised
+            WHERE length(SUPPLIER) > 3 OR length(NORMALIZED_SUPPLIER) > 3
+        )
+        SELECT _order, {', '.join(PAYMENT_COLUMNS)}
+        FROM counted
+        WHERE {redacted} AND ORG_COUNT = 1
+    """)
+
+
+def select_columns(con, table, columns):
+    """`columns` of `table`, with integer NHSSpend_* and contractsfinder_* columns as DOUBLE.
+
+    Those columns only come from one source. In the pandas path the other
+    sources' rows leave them NaN, via the concat for merged_all_raw and the
+    left merge in finalise_groupby, so they are float64 and are written as
+    "123.0". Left as integers, each csv chunk would also get its own dtype.
+    """
+    column_types = dict(con.execute("SELECT column_name, data_type FROM duckdb_columns() "
+                                    f"WHERE table_name = '{table}'").fetchall())
+    integer_types = {'TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT',
+                     'UTINYINT', 'USMALLINT', 'UINTEGER', 'UBIGINT'}
+    return ', '.join(f'CAST({col} AS DOUBLE) AS {col}'
+                     if column_types[col] in integer_types and col.startswith(('NHSSpend_', 'contractsfinder_'))
+                     else col
+                     for col in columns)
+
+
+def write_payments(con, output_format):
+    """Stream merged_all_raw out of the payments table.
+
+    csvs are written in chunks through pandas so they are formatted as in
+    build_groupby_in_memory; parquet is copied out by DuckDB directly,
+    partitioned the same way as output_writer.write_payments.
+    """
+    query = f"SELECT {select_columns(con, 'payments', PAYMENT_COLUMNS)} FROM payments ORDER BY _order"
+    if output_format == 'csv':
+        path = raw_data_path('merged_all_raw.csv')
+        result = con.execute(query)
+        result.fetch_df_chunk(64).to_csv(path, index=False)
+        while True:
+            chunk = result.fetch_df_chunk(64)
+            if chunk.empty:
+                break
+            chunk.to_csv(path, index=False, header=False, mode='a')
+    else:
+        path = clear_payments_dataset().replace("'", "''")
+        con.execute(f"""
+            COPY (SELECT *, right(date, 4) AS year FROM ({query}))
+            TO '{path}' (FORMAT PARQUET, PARTITION_BY (data_source, year), COMPRESSION ZSTD,
+                         OVERWRITE_OR_IGNORE true)
+        """)
+
+
+def fetch_supplier_groupby(con):
+    """Per-supplier equivalent of the pivot_table/unique_agg, sum and value_counts steps."""
+    unique_lists = []
+    for col in UNIQUE_COLUMNS:
+        unique_lists.append(f"""
+            {col}_lists AS (
+                SELECT SUPPLIER, list({col} ORDER BY _first) AS {col}
+                FROM (SELECT SUPPLIER, {col}, min(_order) AS _first
+                      FROM payments GROUP BY SUPPLIER, {col})
+                GROUP BY SUPPLIER
+            )""")
+    joins = ' '.join(f"JOIN {col}_lists USING (SUPPLIER)" for col in UNIQUE_COLUMNS)
+    df_agg = con.execute(f"""
+        WITH {','.join(unique_lists)},
+        totals AS (
+            SELECT SUPPLIER, fsum(amount ORDER BY _order) AS amount, count(*) AS count
+            FROM payments GROUP BY SUPPLIER
+        )
+        SELECT SUPPLIER, {', '.join(UNIQUE_COLUMNS)}, amount, count
+        FROM totals {joins}
+        ORDER BY SUPPLIER
+    """).df()
+    for col in UNIQUE_COLUMNS:
+        df_agg[col] = df_agg[col].apply(lambda x: [np.nan if value is None else value for value in x])
+    df_counts = df_agg[['SUPPLIER', 'count']]
+    return df_agg.drop(columns='count'), df_counts
+
+
+def fetch_nhs_ids(con):
+    columns = select_columns(con, 'nhs', ['supplier',
+                                          'NHSSpend_CompanyName',
+                                          'NHSSpend_CompanyNumber',
+                                          'NHSSpend_CharityName',
+                                          'NHSSpend_CharityRegNo',
+                                          'NHSSpend_CharitySubNo',
+                                          'NHSSpend_CharityNameNo'])
+    return con.execute(f"""
+        SELECT {columns}
+        FROM nhs
+        GROUP BY ALL
+        ORDER BY min(_order)
+    """).df()
+
+
+def build_groupby_out_of_core(output_format='csv', memory_limit='8GB', temp_directory=None):
+    """Out-of-core version of build_groupby_in_memory.
+
+    The ingest, cleaning and payment-level filters run as DuckDB queries over
+    the raw csvs, with the cleaned payments held in an on-disk database and
+    any large sorts or aggregations spilling to `temp_directory`. Only the
+    per-supplier roll-up is brought back into pandas, for finalise_groupby.
+    """
+    with tempfile.TemporaryDirectory(dir=temp_directory) as workdir:
+        con = duckdb.connect(os.path.join(workdir, 'procurement_matching.duckdb'))
+        con.execute(f"SET memory_limit = '{memory_limit}'")
+        con.execute(f"SET temp_directory = '{workdir}'")
+        con.execute("SET preserve_insertion_order = true")
+        register_udfs(con)
+        create_source_views(con)
+        create_payments_table(con)
+
+        write_payments(con, output_format)
+        df_uniq, df_counts = fetch_supplier_groupby(con)
+        df_uniq = finalise_groupby(df_uniq, df_counts, fetch_nhs_ids(con))
+        payment_count = con.execute("SELECT count(*) FROM payments").fetchone()[0]
+        con.close()
+
+    print(df_uniq.columns)
+    print(df_uniq.head())
+
+    write_groupby(df_uniq, output_format)
+
+    print(f'We are then left with {len(df_uniq)} rows of unique "single" suppliers')
+    print(f'We are then left with {payment_count} rows of unique "single" payments')
+    return df_uniq
@@ -0,0 +1,104 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+
+OUTPUT_FORMATS = ['csv', 'parquet']
+
+# Columns of merged_groupby_raw that hold the unique_agg lists.
+LIST_COLUMNS = ['contractsfinder_region', 'dept']
+
+
+def raw_data_path(name):
+    return os.path.join(os.getcwd(), '..', 'raw_data', name)
+
+
+def matches_path(name):
+    return os.path.join('..', 'matches', name)
+
+
+def payment_years(dates):
+    """The year of the 'dd-mm-YYYY' payment dates, used as a partition key."""
+    return dates.str[-4:]
+
+
+def lists_to_arrow(series):
+    return series.apply(lambda x: [None if pd.isnull(value) else value for value in x])
+
+
+def clear_payments_dataset():
+    """Remove any earlier merged_all_raw dataset and return its path.
+
+    Partitioned writers add files to existing partitions rather than
+    replacing them, so a rerun would otherwise duplicate every payment.
+    """
+    path = raw_data_path('merged_all_raw')
+    shutil.rmtree(path, ignore_errors=True)
+    return path
+
+
+def write_payments(df_comb, output_format):
+    """Write merged_all_raw, partitioned by data_source and year as parquet."""
+    if output_format == 'csv':
+        df_comb.to_csv(raw_data_path('merged_all_raw.csv'), index=False)
+    else:
+        df_comb = df_comb.assign(year=payment_years(df_comb['date']))
+        df_comb.to_parquet(clear_payments_dataset(),
+                           partition_cols=['data_source', 'year'],
+                           compression='zstd',
+                           index=False)
+
+
+def write_groupby(df_uniq, output_format):
+    if output_format == 'csv':
+        df_uniq.to_csv(raw_data_path('merged_groupby_raw.csv'), index=False)
+    else:
+        # The index is kept so that the match results can be joined back on by
+        # read_groupby_with_matches exactly as main joins them.
+        df_uniq = df_uniq.copy()
+        for col in LIST_COLUMNS:
+            df_uniq[col] = lists_to_arrow(df_uniq[col])
+        df_uniq.to_parquet(raw_data_path('merged_groupby_raw.parquet'),
+                           compression='zstd')
+
+
+def write_matches(df_results, match_type, output_format):
+    if output_format == 'csv':
+        df_results.to_csv(matches_path(f'matches_to_{match_type}.csv'))
+    else:
+        df_results.to_parquet(matches_path(f'matches_to_{match_type}.parquet'),
+                              compression='zstd')
+
+
+def write_groupby_with_matches(df_uniq, name, match_types, null_columns, output_format):
+    """Write merged_groupby_raw with the match results for `match_types` joined on.
+
+    As csv this is the full joined table. As parquet it is a small json
+    manifest pointing at merged_groupby_raw and the matches_to_<type> files
+    already written, which read_groupby_with_matches puts back together.
+    """
+    if output_format == 'csv':
+        df_uniq.to_csv(raw_data_path(f'{name}.csv'), index=False)
+    else:
+        manifest = {'base': 'merged_groupby_raw.parquet',
+                    'null_columns': null_columns,
+                    'matches': [os.path.join('..', 'matches', f'matches_to_{match_type}.parquet')
+                                for match_type in match_types]}
+        with open(raw_data_path(f'{name}.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+
+def read_groupby_with_matches(name):
+    """Rebuild a merged_groupby_with_approximate_* table from its parquet manifest."""
+    path = raw_data_path(f'{name}.json')
+    with open(path) as f:
+        manifest = json.load(f)
+    directory = os.path.dirname(path)
+    df_uniq = pd.read_parquet(os.path.join(directory, manifest['base']))
+    for col in manifest['null_columns']:
+        df_uniq[col] = np.nan
+    for match_file in manifest['matches']:
+        df_uniq = df_uniq.join(pd.read_parquet(os.path.join(directory, match_file)), how='left')
+    return df_uniq.reset_index(drop=True)
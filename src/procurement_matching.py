@@ -1,4 +1,6 @@
 import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import re
 import html
 import numpy as np
@@ -8,21 +10,25 @@ tqdm.pandas()
 
 from matching_helpers import normaliser,\
                              parse_datetime,\
-                             read_raw_data,\
+                             read_all_raw_data,\
+                             read_register,\
                              prepare_nhsspend,\
                              prepare_contractsfinder,\
                              org_counter,\
                              strip_html,\
                              unique_agg,\
-                             process_dates,\
-                             make_matches,\
-                             filter_coercible_to_string
-
-
-def main():
-    df_centgov = read_raw_data('centgov_data.csv', 'Contracts Finder')
-    df_nhs = read_raw_data('nhsspend_data.csv', 'NHSSpend')
-    df_contracts = read_raw_data('contractsfinder_data.csv', 'Contracts Finder')
+                             make_multi_matches,\
+                             filter_coercible_to_string,\
+                             finalise_groupby
+from output_writer import OUTPUT_FORMATS,\
+                          write_payments,\
+                          write_groupby,\
+                          write_matches,\
+                          write_groupby_with_matches
+
+
+def build_groupby_in_memory(output_format='csv'):
+    df_centgov, df_nhs, df_contracts = read_all_raw_data()
     df_centgov = df_centgov[['data_source', 'amount', 'supplier', 'date', 'dept']]
     df_nhs = prepare_nhsspend(df_nhs)
     df_contracts = prepare_contractsfinder(df_contracts)
@@ -103,17 +109,6 @@ def main():
                        left_on='SUPPLIER',
                        right_on='SUPPLIER'
                        )
-    df_uniq[['SUPPLIER', 'ORG_COUNT']] = df_uniq['SUPPLIER'].progress_apply(lambda x: pd.Series(org_counter(x)))
-    df_uniq['NORMALIZED_SUPPLIER'] = df_uniq['SUPPLIER'].progress_apply(normaliser)
-    df_uniq = pd.merge(df_uniq,
-                       df_counts,
-                       how='left',
-                       left_on='SUPPLIER',
-                       right_on='SUPPLIER'
-                       )
-    df_uniq.sort_values(by=['amount'],
-                        ascending=False)
-
     df_uniq1 = df_nhs[['supplier',
                        'NHSSpend_CompanyName',
                        'NHSSpend_CompanyNumber',
@@ -122,30 +117,7 @@ def main():
                        'NHSSpend_CharitySubNo',
                        'NHSSpend_CharityNameNo',
                        'NHSSpend_CharityName']].drop_duplicates()
-    df_uniq = pd.merge(df_uniq,
-                       df_uniq1,
-                       how='left',
-                       left_on='SUPPLIER',
-                       right_on='supplier'
-                       )
-
-    contractsfinder_region = df_sum = df_comb.groupby('SUPPLIER')['amount'].sum().reset_index()
-
-    df_uniq = df_uniq.rename({'count': 'PAYMENT_TOTAL_COUNT',
-                              'amount': 'PAYMENT_TOTAL_AMOUNT'},
-                             axis=1)
-    print(f'Dropping {len(df_uniq[df_uniq["ORG_COUNT"] != 1])} org_count !=1')
-    df_uniq = df_uniq[df_uniq['ORG_COUNT'] == 1]
-    df_uniq = df_uniq.drop(columns='supplier')
-    df_uniq['contractsfinder_awardedToVcse'] = df_uniq['contractsfinder_awardedToVcse'].apply(
-        lambda x: "True" if True in x else "False")
-    df_uniq['deptcount'] = df_uniq['dept'].astype(str).apply(lambda x: x.count(';') + 1)
-    df_uniq['date'] = df_uniq['date'].astype(str).progress_apply(process_dates)
-    df_uniq['SUPPLIER'] = df_uniq['SUPPLIER'].replace('"', "[DQ]", regex=True)
-
-    df_uniq = df_uniq.drop('NHSSpend_CharityNameNo', axis=1)
-    df_uniq = df_uniq.drop('NHSSpend_CharityName', axis=1)
-    df_uniq = df_uniq.drop('NHSSpend_CompanyName', axis=1)
+    df_uniq = finalise_groupby(df_uniq, df_counts, df_uniq1)
 
     df_comb = df_comb.drop('NHSSpend_CharityNameNo', axis=1)
     df_comb = df_comb.drop('NHSSpend_CharityName', axis=1)
@@ -160,29 +132,49 @@ def main():
     print(df_comb.columns)
     print(df_comb.head())
 
-    df_uniq = df_uniq.sort_values(by='PAYMENT_TOTAL_AMOUNT',
-                                  ascending=False)
-    df_uniq['NORMALIZED_SUPPLIER'] = filter_coercible_to_string(df_uniq['NORMALIZED_SUPPLIER'])
-    df_uniq.to_csv(os.path.join(os.getcwd(),
-                                '..',
-                                'raw_data',
-                                'merged_groupby_raw.csv'),
-                   index=False)
-
-    df_comb.to_csv(os.path.join(os.getcwd(),
-                                '..',
-                                'raw_data',
-                                'merged_all_raw.csv'),
-                   index=False
-                   )
+    write_groupby(df_uniq, output_format)
+    write_payments(df_comb, output_format)
 
     print(f'We are then left with {len(df_uniq)} rows of unique "single" suppliers')
     print(f'We are then left with {len(df_comb)} rows of unique "single" payments')
+    return df_uniq
+
+
+def read_ch():
+    return read_register('BasicCompanyDataAsOneFile-2024-08-01.csv',
+                         ['CompanyName', ' CompanyNumber', 'RegAddress.PostTown', 'RegAddress.PostCode'])
+
+
+def read_spine():
+    return read_register('public_spine.spine.csv',
+                         ['uid', 'organisationname', 'fulladdress', 'city', 'postcode', 'registerdate',
+                          'removeddate'])
+
+
+def main(out_of_core=False, output_format='csv'):
+    if out_of_core:
+        # The registers are read only once the roll-up is done, so that they
+        # are never held in memory alongside it.
+        from out_of_core import build_groupby_out_of_core
+        df_uniq = build_groupby_out_of_core(output_format=output_format)
+        df_ch = read_ch()
+        df_spine = read_spine()
+    else:
+        # The registers are only needed once the payments have been rolled up,
+        # so load them in the background while that happens.
+        executor = ThreadPoolExecutor()
+        df_ch = executor.submit(read_ch)
+        df_spine = executor.submit(read_spine)
+        try:
+            df_uniq = build_groupby_in_memory(output_format)
+        except BaseException:
+            # Raise now rather than once the register reads have finished.
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        df_ch = df_ch.result()
+        df_spine = df_spine.result()
+        executor.shutdown()
 
-    df_ch = pd.read_csv(os.path.join(
-        '..', 'registers', 'BasicCompanyDataAsOneFile-2024-08-01.csv'),
-        usecols=['CompanyName', ' CompanyNumber', 'RegAddress.PostTown', 'RegAddress.PostCode']
-    )
     df_ch['NORMALIZED_CompanyName'] = df_ch['CompanyName'].astype(str).progress_apply(normaliser)
     df_ch['NORMALIZED_CompanyName'] = filter_coercible_to_string(df_ch['NORMALIZED_CompanyName'])
     df_ch = df_ch.drop_duplicates(subset=['NORMALIZED_CompanyName'], keep=False)
@@ -190,10 +182,6 @@ def main():
         [' CompanyNumber', 'NORMALIZED_CompanyName', 'CompanyName', 'RegAddress.PostTown', 'RegAddress.PostCode']]
     df_ch.to_csv(os.path.join('..', 'registers', 'ch_w_normalised.csv'), index=False)
 
-    df_spine = pd.read_csv(os.path.join(
-        '..', 'registers', 'public_spine.spine.csv'),
-        usecols=['uid', 'organisationname', 'fulladdress', 'city', 'postcode', 'registerdate', 'removeddate']
-    )
     df_spine['NORMALIZED_organisationname'] = df_spine['organisationname'].astype(str).progress_apply(normaliser)
     df_spine['NORMALIZED_organisationname'] = filter_coercible_to_string(df_spine['NORMALIZED_organisationname'])
     df_spine = df_spine.drop_duplicates(subset=['NORMALIZED_organisationname'], keep=False)
@@ -202,31 +190,35 @@ def main():
          'removeddate']]
     df_spine.to_csv(os.path.join('..', 'registers', 'spine_w_normalised.csv'), index=False)
 
-    print('Beginning to make the spine matches')
-    df_spine_results = make_matches(df_uniq['NORMALIZED_SUPPLIER'], df_spine['NORMALIZED_organisationname'], 'spine')
-    df_spine_results.to_csv(os.path.join('..', 'matches', 'matches_to_spine.csv'))
-
-    df_uniq['verified_normalized_spine_name'] = np.nan
-    df_uniq['verified_spine_uid'] = np.nan
-    df_uniq['verified_normalized_ch_name'] = np.nan
-    df_uniq['verified_ch_uid'] = np.nan
+    print('Beginning to make the spine and CH matches')
+    df_results = make_multi_matches(df_uniq['NORMALIZED_SUPPLIER'],
+                                    {'spine': df_spine['NORMALIZED_organisationname'],
+                                     'ch': df_ch['NORMALIZED_CompanyName']})
+    df_spine_results = df_results.filter(like='best_spine_')
+    df_ch_results = df_results.filter(like='best_ch_')
+    write_matches(df_spine_results, 'spine', output_format)
+    write_matches(df_ch_results, 'ch', output_format)
+
+    verified_columns = ['verified_normalized_spine_name',
+                        'verified_spine_uid',
+                        'verified_normalized_ch_name',
+                        'verified_ch_uid']
+    for col in verified_columns:
+        df_uniq[col] = np.nan
     df_uniq = df_uniq.join(df_spine_results, how='left')
-    df_uniq.to_csv(os.path.join(os.getcwd(),
-                                '..',
-                                'raw_data',
-                                'merged_groupby_with_approximate_spine.csv'),
-                   index=False)
-
-    print('Beginning to make the CH matches')
-    df_ch_results = make_matches(df_uniq['NORMALIZED_SUPPLIER'], df_ch['NORMALIZED_CompanyName'], 'ch')
-    df_ch_results.to_csv(os.path.join('..', 'matches', 'matches_to_ch.csv'))
+    write_groupby_with_matches(df_uniq, 'merged_groupby_with_approximate_spine',
+                               ['spine'], verified_columns, output_format)
+
     df_uniq = df_uniq.join(df_ch_results, how='left')
-    df_uniq.to_csv(os.path.join(os.getcwd(),
-                               '..',
-                               'raw_data',
-                               'merged_groupby_with_approximate_spine_and_ch.csv'),
-                   index=False)
+    write_groupby_with_matches(df_uniq, 'merged_groupby_with_approximate_spine_and_ch',
+                               ['spine', 'ch'], verified_columns, output_format)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out-of-core', action='store_true',
+                        help='run the ingest and supplier roll-up in DuckDB, spilling to disk')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='csv',
+                        help='write csvs, or zstd parquet partitioned by data_source and year')
+    args = parser.parse_args()
+    main(out_of_core=args.out_of_core, output_format=args.output_format)
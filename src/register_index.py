@@ -0,0 +1,174 @@
+import os
+import json
+import argparse
+import hashlib
+import numpy as np
+import pandas as pd
+from thefuzz import process as thefuzz_process
+from thefuzz import utils as thefuzz_utils
+
+from matching_helpers import normaliser,\
+                             match_columns,\
+                             match_rows
+
+
+INDEX_VERSION = 1
+
+# register name -> (normalised register csv written by main, name column, id column)
+REGISTERS = {
+    'spine': ('spine_w_normalised.csv', 'NORMALIZED_organisationname', 'uid'),
+    'ch': ('ch_w_normalised.csv', 'NORMALIZED_CompanyName', ' CompanyNumber'),
+}
+
+INDEX_ARRAYS = ['names', 'name_offsets', 'ids', 'id_offsets',
+                'token_hashes', 'token_offsets', 'postings']
+
+
+def tokenise(name):
+    return set(thefuzz_utils.full_process(name, force_ascii=True).split())
+
+
+def token_hash(token):
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def encode_strings(values):
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def index_path(register):
+    return os.path.join('..', 'registers', f'{register}_index')
+
+
+def build_register_index(names, ids, path):
+    """Write the normalised names, ids and a token lookup for a register to `path`.
+
+    Everything is stored as flat .npy arrays so that RegisterIndex can
+    memory-map them: strings as a utf-8 blob plus offsets, and the
+    candidate lookup as sorted token hashes with CSR postings of the rows
+    containing each token.
+    """
+    names = names.astype(str).tolist()
+    ids = ids.fillna('').astype(str).tolist()
+    os.makedirs(path, exist_ok=True)
+
+    hashes, rows = [], []
+    for row, name in enumerate(names):
+        for token in tokenise(name):
+            hashes.append(token_hash(token))
+            rows.append(row)
+    hashes = np.array(hashes, dtype=np.uint64)
+    rows = np.array(rows, dtype=np.int32)
+    order = np.lexsort((rows, hashes))
+    token_hashes, starts = np.unique(hashes[order], return_index=True)
+
+    arrays = {'token_hashes': token_hashes,
+              'token_offsets': np.append(starts, len(hashes)).astype(np.int64),
+              'postings': rows[order]}
+    arrays['names'], arrays['name_offsets'] = encode_strings(names)
+    arrays['ids'], arrays['id_offsets'] = encode_strings(ids)
+    for array_name in INDEX_ARRAYS:
+        np.save(os.path.join(path, array_name + '.npy'), arrays[array_name])
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'version': INDEX_VERSION, 'count': len(names)}, f)
+
+
+class RegisterIndex:
+    """A read-only, memory-mapped register index written by build_register_index.
+
+    Opening only maps the arrays, so it is cheap and the pages are shared
+    between every process that has the same index open. Candidates are the
+    register names sharing a token with the query; they are scored with the
+    same thefuzz scorer as make_matches.
+    """
+
+    def __init__(self, path, max_candidates=50000):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != INDEX_VERSION:
+            raise ValueError(f'{path} is a version {meta["version"]} index, expected {INDEX_VERSION}')
+        self.count = meta['count']
+        self.max_candidates = max_candidates
+        for array_name in INDEX_ARRAYS:
+            setattr(self, array_name, np.load(os.path.join(path, array_name + '.npy'), mmap_mode='r'))
+
+    def name(self, row):
+        return self.names[self.name_offsets[row]:self.name_offsets[row + 1]].tobytes().decode('utf-8')
+
+    def register_id(self, row):
+        return self.ids[self.id_offsets[row]:self.id_offsets[row + 1]].tobytes().decode('utf-8')
+
+    def candidates(self, normalised_name):
+        hashes = np.array([token_hash(token) for token in tokenise(normalised_name)], dtype=np.uint64)
+        found = np.searchsorted(self.token_hashes, hashes)
+        postings = [self.postings[self.token_offsets[i]:self.token_offsets[i + 1]]
+                    for i, hashed in zip(found, hashes)
+                    if i < len(self.token_hashes) and self.token_hashes[i] == hashed]
+        if not postings:
+            return np.empty(0, dtype=np.int32)
+        # Rarest tokens first; very common ones ("LTD", "CIC") are only used
+        # while the candidate set stays under max_candidates.
+        postings.sort(key=len)
+        selected = [postings[0]]
+        total = len(postings[0])
+        for rows in postings[1:]:
+            if total + len(rows) > self.max_candidates:
+                break
+            selected.append(rows)
+            total += len(rows)
+        return np.unique(np.concatenate(selected))
+
+    def match_normalised(self, normalised_name, limit=5):
+        choices = {int(row): self.name(row) for row in self.candidates(normalised_name)}
+        if not choices:
+            return []
+        return [(name, score, self.register_id(row))
+                for name, score, row in thefuzz_process.extract(normalised_name, choices, limit=limit)]
+
+    def match(self, supplier, limit=5):
+        """Top `limit` (normalised name, score, id) matches for one raw supplier name."""
+        return self.match_normalised(normaliser(supplier), limit=limit)
+
+    def match_batch(self, suppliers, match_type, limit=5):
+        """Match raw supplier names, returning the best_<match_type>_match_N columns."""
+        normalised = [normaliser(supplier) for supplier in suppliers]
+        matches = {name: self.match_normalised(name, limit=limit) for name in dict.fromkeys(normalised)}
+        # Unlike make_matches only the candidates are scored, so there can be
+        # fewer than `limit` matches; pad so every row fills the columns.
+        results = []
+        for name in normalised:
+            result = [(match, score) for match, score, _ in matches[name]]
+            results.append(result + [(None, None)] * (limit - len(result)))
+        return pd.DataFrame(match_rows(results), columns=match_columns(match_type, limit))
+
+
+def build_register_indexes(registers=None):
+    for register in registers or REGISTERS:
+        fname, name_column, id_column = REGISTERS[register]
+        df_register = pd.read_csv(os.path.join('..', 'registers', fname),
+                                  usecols=[name_column, id_column],
+                                  dtype=str)
+        df_register = df_register[df_register[name_column].notnull()]
+        print(f'Building the {register} index from {len(df_register)} names')
+        build_register_index(df_register[name_column], df_register[id_column], index_path(register))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='build indexes from the *_w_normalised.csv registers')
+    build_parser.add_argument('registers', nargs='*', help='any of ' + ', '.join(REGISTERS) + ' (default: all)')
+    match_parser = subparsers.add_parser('match', help='match supplier names against a built index')
+    match_parser.add_argument('register', choices=list(REGISTERS))
+    match_parser.add_argument('suppliers', nargs='+')
+    match_parser.add_argument('--limit', type=int, default=5)
+    args = parser.parse_args()
+    if args.command == 'build':
+        build_register_indexes(args.registers)
+    else:
+        index = RegisterIndex(index_path(args.register))
+        for supplier in args.suppliers:
+            print(supplier, index.match(supplier, limit=args.limit))